@@ -8,10 +8,26 @@ TODO list:
 * Document append Document or ("col_nae", col) tuple
 * deal with errors in transforms
 """
+import bz2
+import cPickle
 import csv
-from collections import namedtuple, OrderedDict
+import functools
+import hashlib
+import marshal
+import math
+import operator
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import weakref
+import zlib
+from collections import namedtuple, Counter, OrderedDict, Sequence
 from cStringIO import StringIO
-from itertools import imap, izip
+from itertools import compress, count, imap, islice, izip, izip_longest
+from operator import attrgetter, itemgetter
 
 class Column(tuple):
     """An immutable sequence of elements that represent every element in a
@@ -29,18 +45,533 @@ class Column(tuple):
     small set of possible values ("M/F", "Y/N", etc.), lending themselves well
     to bitarray or RLE encodings. But memory efficiency isn't a major goal for
     this iteration, so we'll just do the simplest thing. Later on, we'd probably
-    make Column an instance of an ABC.
+    make Column an instance of an ABC. (:class:`CompressedColumn` is a first
+    step in that direction, for columns that are mostly just carried around.)
     """
     def __eq__(self, other):
         """We're a little more forgiving than a tuple comparison -- we'll allow
-        comparisons to lists and other iterables by casting them to tuples."""
-        return super(Column, self).__eq__(tuple(other))
+        comparisons to lists and other iterables by casting them to tuples.
+
+        Comparing two Columns checks identity, length, and the (cached) hashes
+        of their contents before falling back to comparing element by element,
+        so Columns that differ are usually rejected without touching the data.
+        """
+        if isinstance(other, (Column, _SequenceColumn)):
+            return _columns_equal(self, other)
+        if not isinstance(other, tuple):
+            other = tuple(other)
+        if len(self) != len(other):
+            return False
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        content_hash = self._content_hash()
+        if content_hash is None:
+            # Let tuple raise the appropriate TypeError
+            return tuple.__hash__(self)
+        return content_hash
+
+    def _known_content_hash(self):
+        """The content hash to use when comparing Columns. It's cheap to work
+        out for a Column, so we always do."""
+        return self._content_hash()
+
+    def _content_hash(self):
+        """Return the hash of this Column's contents, or None if it has elements
+        that can't be hashed. Columns are immutable, so we only compute this
+        once."""
+        try:
+            return self._cached_hash
+        except AttributeError:
+            try:
+                self._cached_hash = tuple.__hash__(self)
+            except TypeError:
+                self._cached_hash = None
+            return self._cached_hash
+
+    def __reduce__(self):
+        # Leave out the cached hash, which isn't valid in a process with a
+        # different hash seed.
+        return (Column, (tuple(self),))
 
     @property
     def unique(self):
         """Return a frozenset of the unique elements in this Column."""
         return frozenset(self)
 
+class _SequenceColumn(Sequence):
+    """Base class for read-only stand-ins for :class:`Column` that store their
+    elements somewhere other than a tuple. Subclasses must implement
+    `__getitem__`, `__iter__` and `__len__`. They compare and hash the same
+    as a Column with the same elements, so Documents don't care which kind
+    they're holding."""
+    @property
+    def unique(self):
+        """Return a frozenset of the unique elements in this Column."""
+        return frozenset(self)
+
+    def _content_hash(self):
+        """Same as :meth:`Column._content_hash`."""
+        try:
+            return self._cached_hash
+        except AttributeError:
+            try:
+                self._cached_hash = hash(tuple(self))
+            except TypeError:
+                self._cached_hash = None
+            return self._cached_hash
+
+    def _known_content_hash(self):
+        """The content hash to use when comparing Columns, if we've already
+        worked it out. Computing it means reading every element (and holding
+        them all in a tuple), which is what we're trying to avoid, so we
+        don't do that just to compare."""
+        return getattr(self, '_cached_hash', None)
+
+    def __eq__(self, other):
+        if isinstance(other, (Column, _SequenceColumn)):
+            return _columns_equal(self, other)
+        return Column(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        content_hash = self._content_hash()
+        if content_hash is None:
+            raise TypeError("%s has unhashable elements" %
+                            type(self).__name__)
+        return content_hash
+
+    def __getstate__(self):
+        # Same as Column.__reduce__
+        state = self.__dict__.copy()
+        state.pop('_cached_hash', None)
+        return state
+
+def _columns_equal(col, other):
+    """Compare two Columns (of any kind) by checking identity, length and any
+    known content hashes before comparing them element by element. Elements
+    are compared as they're read, so a CompressedColumn or SpillableColumn
+    is only read once and never held in memory all at once."""
+    if col is other:
+        return True
+    if len(col) != len(other):
+        return False
+    col_hash, other_hash = col._known_content_hash(), other._known_content_hash()
+    if (col_hash is not None) and (other_hash is not None) and \
+       (col_hash != other_hash):
+        return False
+    if isinstance(col, Column) and isinstance(other, Column):
+        return tuple.__eq__(col, other)
+    return all(imap(operator.eq, col, other))
+
+def _serialize_block(block):
+    """Return a (loads, data) pair for a tuple of values. marshal is much faster
+    than pickle, but only knows about builtin types."""
+    try:
+        return (marshal.loads, marshal.dumps(block))
+    except ValueError:
+        return (cPickle.loads, cPickle.dumps(block, cPickle.HIGHEST_PROTOCOL))
+
+class CompressedColumn(_SequenceColumn):
+    """A read-only stand-in for a :class:`Column` that keeps its elements
+    compressed in memory. This is meant for bulky columns (free text notes,
+    addresses, etc.) that are carried through a Document without being looked
+    at much. You'll normally get these from :meth:`Document.compress` or the
+    `compress_cols` argument of :func:`load` rather than making them yourself.
+
+    Elements are stored in blocks of `block_size` values, each of which is
+    serialized and compressed with `codec` ("zlib" or "bz2"). Random access
+    decompresses the block holding the element, and the most recently used
+    `cached_blocks` blocks are kept around decompressed so that nearby
+    lookups are cheap. Iterating (which is what iterrows() and friends do)
+    streams through the blocks one at a time without touching the cache.
+
+    Use ``Column(compressed_col)`` to get an uncompressed copy back.
+    """
+    CODECS = {
+        "zlib": (zlib.compress, zlib.decompress),
+        "bz2": (bz2.compress, bz2.decompress),
+    }
+
+    def __init__(self, values=(), codec="zlib", block_size=4096,
+                 cached_blocks=2):
+        self._start(codec, block_size, cached_blocks)
+        values = iter(values)
+        for block in iter(lambda: list(islice(values, block_size)), []):
+            self._extend(block)
+        self._finish()
+
+    @classmethod
+    def _builder(cls, codec="zlib", block_size=4096, cached_blocks=2):
+        """Return an empty CompressedColumn to be filled in with _extend() and
+        then _finish()ed. This lets load() compress a column a batch of rows at
+        a time, instead of holding the whole thing uncompressed first."""
+        col = cls.__new__(cls)
+        col._start(codec, block_size, cached_blocks)
+        return col
+
+    def _start(self, codec, block_size, cached_blocks):
+        if codec not in self.CODECS:
+            raise ValueError("Unknown CompressedColumn codec %r (must be one " \
+                             "of %s)" % (codec, sorted(self.CODECS)))
+        if block_size < 1:
+            raise ValueError("CompressedColumn block_size must be at least 1, " \
+                             "not %r" % (block_size,))
+        self._codec = codec
+        self._block_size = block_size
+        self._cached_blocks = cached_blocks
+        self._block_cache = OrderedDict()
+        self._blocks = []
+        self._len = 0
+        self._pending = []
+
+    def _extend(self, values):
+        """Add `values` to the end of this Column, compressing every full block
+        we have. Only for use while building (see _builder())."""
+        pending = self._pending
+        pending.extend(values)
+        num_full = len(pending) - (len(pending) % self._block_size)
+        if num_full:
+            compress = self.CODECS[self._codec][0]
+            for start in xrange(0, num_full, self._block_size):
+                self._blocks.append(self._compress_block(
+                    pending[start:start + self._block_size], compress
+                ))
+            self._len += num_full
+            del pending[:num_full]
+
+    def _finish(self):
+        """Compress whatever is left over from _extend() as the last block."""
+        if self._pending:
+            compress = self.CODECS[self._codec][0]
+            self._blocks.append(self._compress_block(self._pending, compress))
+            self._len += len(self._pending)
+        self._pending = None
+
+    @staticmethod
+    def _compress_block(block, compress):
+        """Return a (loads, compressed data) pair for a list of values."""
+        loads, data = _serialize_block(tuple(block))
+        return (loads, compress(data))
+
+    def _decompress_block(self, block_index):
+        loads, data = self._blocks[block_index]
+        return loads(self.CODECS[self._codec][1](data))
+
+    def _get_block(self, block_index):
+        try:
+            block = self._block_cache.pop(block_index)
+        except KeyError:
+            block = self._decompress_block(block_index)
+            if not self._cached_blocks:
+                return block
+            if len(self._block_cache) >= self._cached_blocks:
+                self._block_cache.popitem(last=False)
+        self._block_cache[block_index] = block
+        return block
+
+    @property
+    def compressed_size(self):
+        """Number of bytes of compressed data held by this CompressedColumn."""
+        return sum(len(data) for loads, data in self._blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in xrange(*index.indices(self._len)))
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("CompressedColumn index out of range")
+        block_index, offset = divmod(index, self._block_size)
+        return self._get_block(block_index)[offset]
+
+    def __iter__(self):
+        for block_index in xrange(len(self._blocks)):
+            for value in self._decompress_block(block_index):
+                yield value
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return "CompressedColumn(<%d values in %d %s blocks>)" % \
+               (self._len, len(self._blocks), self._codec)
+
+class MemoryBudget(object):
+    """A MemoryBudget keeps the Columns it's tracking under `max_bytes` of
+    (estimated) memory by spilling the least recently used ones to temporary
+    files in `spill_dir` (a new temp directory by default). Spilled Columns
+    are read back in transparently when they're accessed by index, and are
+    streamed from disk (without being read back in) when they're iterated
+    over, which is what iterrows() and friends do.
+
+    Pass one to :func:`load` or :meth:`Document.with_memory_budget`. Columns
+    made by transforming a Document that is under a budget (with map(),
+    select(), etc.) are tracked by the same budget::
+
+        budget = csvcols.MemoryBudget(2 * 1024 ** 3)
+        orders_doc = csvcols.load(open("month_end.csv"), memory_budget=budget)
+
+    If we made the spill directory, we delete it when the MemoryBudget is
+    garbage collected (which can't happen until all its Columns are).
+
+    Sizes are estimated from a sample of each Column's values, so treat
+    `max_bytes` as approximate. It's a cap on Column data, not on the whole
+    process, and a Column that is being read or built is always allowed in
+    memory, even if it's bigger than the budget by itself.
+    """
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._made_spill_dir = False
+        self.resident_bytes = 0
+        self._resident_cols = weakref.WeakSet()
+        self._clock = count()
+
+    @property
+    def spill_dir(self):
+        """The directory spilled Columns are written to."""
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="csvcols-spill-")
+            self._made_spill_dir = True
+        elif not os.path.isdir(self._spill_dir):
+            os.makedirs(self._spill_dir)
+        return self._spill_dir
+
+    def enforce(self, extra_bytes=0, keep=None):
+        """Spill the least recently used Columns (other than `keep`) until the
+        Columns we're tracking, plus `extra_bytes`, fit in the budget."""
+        if self.resident_bytes + extra_bytes <= self.max_bytes:
+            return
+        lru_cols = sorted((col for col in self._resident_cols if col is not keep),
+                          key=attrgetter('_last_used'))
+        for col in lru_cols:
+            if self.resident_bytes + extra_bytes <= self.max_bytes:
+                break
+            col.spill()
+
+    def __del__(self):
+        # Guard against being collected at interpreter shutdown.
+        try:
+            if self._made_spill_dir:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+        except Exception:
+            pass
+
+    def _add_resident(self, col):
+        self._resident_cols.add(col)
+        self.resident_bytes += col._est_bytes
+
+    def _remove_resident(self, col):
+        self._resident_cols.discard(col)
+        self.resident_bytes -= col._est_bytes
+
+def _estimate_bytes(values):
+    """Rough number of bytes of memory taken up by a list or tuple of values,
+    based on a sample of at most 100 of them."""
+    if not values:
+        return 0
+    sample_vals = values[::max(1, len(values) // 100)]
+    avg_bytes = sum(imap(sys.getsizeof, sample_vals)) / float(len(sample_vals))
+    return int(len(values) * (avg_bytes + POINTER_BYTES))
+
+POINTER_BYTES = struct.calcsize("P")
+
+class _SpillFile(object):
+    """An append-only temp file of compressed blocks of values.
+
+    The classmethods read and write the same block format on any file, which
+    is how :class:`Pipeline` checkpoints store their Columns. There, each
+    Column's blocks are followed by END_OF_BLOCKS.
+    """
+    BLOCK_SIZE = 4096
+    BLOCK_HEADER = struct.Struct("<BI") # (loads index, compressed length)
+    LOADS = (marshal.loads, cPickle.loads)
+    END_OF_BLOCKS = BLOCK_HEADER.pack(len(LOADS), 0)
+
+    def __init__(self, spill_dir):
+        fd, self.path = tempfile.mkstemp(dir=spill_dir, suffix=".spill")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, values):
+        self.write_blocks(self._file, values)
+
+    def write_raw_block(self, raw_block):
+        """Write a block as returned by iter_raw_blocks()."""
+        self._file.write(raw_block)
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        # Open the file now rather than when the generator first runs, so that
+        # iterating still works if the file is removed in the meantime (e.g.
+        # because its Column was garbage collected).
+        return self._iter_values(open(self.path, "rb"))
+
+    def _iter_values(self, spill_file):
+        with spill_file:
+            for value in self.iter_block_values(spill_file):
+                yield value
+
+    @classmethod
+    def write_blocks(cls, out_file, values):
+        """Write an iterable of values to `out_file`, a block at a time."""
+        values = iter(values)
+        for block in iter(lambda: tuple(islice(values, cls.BLOCK_SIZE)), ()):
+            loads, data = _serialize_block(block)
+            data = zlib.compress(data, 1)
+            out_file.write(cls.BLOCK_HEADER.pack(cls.LOADS.index(loads),
+                                                 len(data)))
+            out_file.write(data)
+
+    @classmethod
+    def iter_raw_blocks(cls, in_file):
+        """Yield each block (header and compressed data) in `in_file`, up to
+        END_OF_BLOCKS or the end of the file."""
+        while True:
+            header = in_file.read(cls.BLOCK_HEADER.size)
+            if (not header) or (header == cls.END_OF_BLOCKS):
+                break
+            loads_index, length = cls.BLOCK_HEADER.unpack(header)
+            yield header + in_file.read(length)
+
+    @classmethod
+    def iter_block_values(cls, in_file):
+        """Yield the values in `in_file`, up to END_OF_BLOCKS or the end of the
+        file."""
+        header_size = cls.BLOCK_HEADER.size
+        for raw_block in cls.iter_raw_blocks(in_file):
+            loads_index, length = cls.BLOCK_HEADER.unpack(raw_block[:header_size])
+            for value in cls.LOADS[loads_index](
+                             zlib.decompress(raw_block[header_size:])):
+                yield value
+
+    def remove(self):
+        self._file.close()
+        os.remove(self.path)
+
+class SpillableColumn(_SequenceColumn):
+    """A read-only stand-in for a :class:`Column` whose elements can be spilled
+    to a temp file by a :class:`MemoryBudget` when memory gets tight. You'll
+    normally get these from the `memory_budget` argument of :func:`load` or
+    from :meth:`Document.with_memory_budget` rather than making them yourself.
+
+    Accessing a spilled SpillableColumn by index reads the whole thing back
+    into memory (which may spill other Columns). Iterating over a spilled
+    SpillableColumn streams it from disk instead. The temp file is written
+    the first time the Column is spilled and deleted when the Column is
+    garbage collected, so spilling it again later is free.
+    """
+    def __init__(self, values, memory_budget):
+        self._budget = memory_budget
+        self._values = tuple(values)
+        self._len = len(self._values)
+        self._est_bytes = _estimate_bytes(self._values)
+        self._spill_file = None
+        self._last_used = next(memory_budget._clock)
+        memory_budget._add_resident(self)
+        memory_budget.enforce(keep=self)
+
+    @classmethod
+    def _from_spill_file(cls, spill_file, length, est_bytes, memory_budget):
+        """Create an already spilled SpillableColumn from a closed
+        :class:`_SpillFile`."""
+        col = cls.__new__(cls)
+        col._budget = memory_budget
+        col._values = None
+        col._len = length
+        col._est_bytes = est_bytes
+        col._spill_file = spill_file
+        col._last_used = next(memory_budget._clock)
+        return col
+
+    @property
+    def spilled(self):
+        """True if this Column's values are on disk rather than in memory."""
+        return self._values is None
+
+    def spill(self):
+        """Write this Column out to disk (if it isn't already) and drop it from
+        memory."""
+        if self._values is None:
+            return
+        if self._spill_file is None:
+            spill_file = _SpillFile(self._budget.spill_dir)
+            spill_file.write(self._values)
+            spill_file.close()
+            self._spill_file = spill_file
+        self._budget._remove_resident(self)
+        self._values = None
+
+    def _page_in(self):
+        self._budget.enforce(extra_bytes=self._est_bytes)
+        self._values = tuple(self._spill_file)
+        self._budget._add_resident(self)
+
+    def __getitem__(self, index):
+        if self._values is None:
+            self._page_in()
+        self._last_used = next(self._budget._clock)
+        return self._values[index]
+
+    def __iter__(self):
+        self._last_used = next(self._budget._clock)
+        if self._values is None:
+            return iter(self._spill_file)
+        return iter(self._values)
+
+    def __len__(self):
+        return self._len
+
+    def __del__(self):
+        # Guard against being collected at interpreter shutdown, or before
+        # __init__ finished.
+        try:
+            if self._values is not None:
+                self._budget._remove_resident(self)
+            if self._spill_file is not None:
+                self._spill_file.remove()
+        except Exception:
+            pass
+
+    def __reduce__(self):
+        # Spill files and budgets belong to this process, so we pickle as a
+        # plain Column.
+        return (Column, (tuple(self),))
+
+    def __repr__(self):
+        return "SpillableColumn(<%d values, %s>)" % \
+               (self._len, "spilled" if self.spilled else "in memory")
+
+class DocumentDiff(namedtuple('DocumentDiff', ['added_cols', 'removed_cols',
+                                               'changed_cols', 'added_rows',
+                                               'removed_rows',
+                                               'changed_rows'])):
+    """The result of :meth:`Document.diff`. It's a namedtuple with the
+    following fields:
+
+    `added_cols`, `removed_cols`, `changed_cols`
+        Tuples of column names.
+    `added_rows`, `removed_rows`
+        Tuples of Row objects from the new and old Documents respectively.
+    `changed_rows`
+        A tuple of (old_row, new_row) pairs. Only filled in when the diff was
+        made with a `key`.
+
+    A DocumentDiff is only true if there are differences, so you can just do
+    ``if new_doc.diff(old_doc): ...``
+    """
+    __slots__ = ()
+
+    def __nonzero__(self):
+        return any(self)
+
 class Document(object):
     """A Document is a way to group Columns together and give them names.
     A Column object is just data, it has no name or identifier.  This is a
@@ -77,25 +608,65 @@ class Document(object):
         # hard-coded names in code. Parsing code should always call this method
         # with unicode names instead of relying on this method to do it.
         name_col_pairs = [(unicode(name), col) for name, col in name_col_pairs]
-        self._names_to_cols = OrderedDict(name_col_pairs)
-        if not self._names_to_cols:
-            raise TypeError("Document must have at least one Column")
-        if len(name_col_pairs) != len(self._names_to_cols):
+        names = tuple(name for name, col in name_col_pairs)
+        columns = tuple(col for name, col in name_col_pairs)
+        self._validate(names, columns)
+        self._init_fields(names, columns)
+
+    @classmethod
+    def _from_trusted(cls, names, columns, Row=None, memory_budget=None):
+        """Create a Document without validating its inputs. This is the path
+        used when deriving Documents from existing ones, where we already know
+        that `names` is a tuple of unique unicode names and `columns` is a
+        tuple of Columns that are all the same length. If the new Document has
+        the same names as an existing one, pass its `Row` class along so we
+        don't have to build another one."""
+        doc = cls.__new__(cls)
+        doc._init_fields(names, columns, Row, memory_budget)
+        return doc
+
+    @staticmethod
+    def _check_unique_names(names):
+        if len(frozenset(names)) != len(names):
             raise TypeError("Document must have unique names for Columns: %s" %
-                            [name for name, col in name_col_pairs])
+                            list(names))
+
+    @classmethod
+    def _validate(cls, names, columns):
+        if not names:
+            raise TypeError("Document must have at least one Column")
+        cls._check_unique_names(names)
 
         # Check: All columns have the same length
-        column_lengths = [len(col) for col in self.columns]
+        column_lengths = [len(col) for col in columns]
         if len(frozenset(column_lengths)) > 1:
             raise TypeError("Document's Columns must have the same length: " \
-                            "%s" % zip(self.names, column_lengths))
+                            "%s" % zip(names, column_lengths))
+
+    def _init_fields(self, names, columns, Row=None, memory_budget=None):
+        self._names = names
+        self._columns = columns
+        self._names_to_cols = dict(izip(names, columns))
+
+        # New Columns made from this Document are tracked by this (see
+        # with_memory_budget())
+        self._memory_budget = memory_budget
 
         # We create a custom Row object for every Document, that you can use
-        # either as a tuple or an ordered dict. Accessible via rows or iterrows()
-        self.Row = self._create_row_class()
+        # either as a tuple or an ordered dict. Accessible via rows or
+        # iterrows(). It's built lazily, since most intermediate Documents
+        # never have their rows looked at.
+        self._Row = Row
 
         # Caching
         self._cached_rows = None
+        self._fingerprint = None
+
+    def _make_column(self, values):
+        """Make a new Column for a Document derived from this one."""
+        if self._memory_budget is None:
+            return Column(values)
+        return SpillableColumn(values, self._memory_budget)
 
     def _create_row_class(self):
         Row = namedtuple('Row', self.names, rename=True)
@@ -113,15 +684,22 @@ class Document(object):
         return Row
 
     ############################# Simple Accessors #############################
+    @property
+    def Row(self):
+        """The Row class for this Document (see the class docstring)."""
+        if self._Row is None:
+            self._Row = self._create_row_class()
+        return self._Row
+
     @property
     def columns(self):
-        """An ordered list of the Column objects in this Document."""
-        return self._names_to_cols.values()
+        """An ordered tuple of the Column objects in this Document."""
+        return self._columns
 
     @property
     def names(self):
-        """An ordered list of the column names in this Document."""
-        return self._names_to_cols.keys()
+        """An ordered tuple of the column names in this Document."""
+        return self._names
 
     @property
     def rows(self):
@@ -130,11 +708,31 @@ class Document(object):
             self._cached_rows = tuple(self.iterrows())
         return self._cached_rows
 
+    @property
+    def fingerprint(self):
+        """A hex digest that identifies the names and contents of this Document.
+        Unlike `hash()`, it is stable across processes, so it can be used to key
+        things that are stored on disk (see :class:`Pipeline`). Every value in
+        the Document must be picklable.
+
+        Documents that are equal will almost always have the same fingerprint,
+        but that isn't guaranteed (e.g. dicts whose keys are ordered
+        differently, or Documents produced by a :class:`Pipeline` stage, which
+        are fingerprinted by how they were made rather than by content).
+        Documents with the same fingerprint are equal."""
+        if self._fingerprint is None:
+            sha = hashlib.sha1()
+            for name, col in self:
+                sha.update(cPickle.dumps((name, tuple(col)),
+                                         cPickle.HIGHEST_PROTOCOL))
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
     @property
     def num_rows(self):
         """All Columns in this Document are the same length, and a Document
         must have at least one Column, so we just return its length."""
-        return len(self[0])
+        return len(self._columns[0])
 
     def iterrows(self):
         """Iterate through the Document row by row. Returns a generator of
@@ -147,7 +745,8 @@ class Document(object):
                 print row["-LAST NAME-"] # access using column names
                 print row[3] # access with simple index
         """
-        return (self.Row(*row_vals) for row_vals in izip(*self.columns))
+        Row = self.Row
+        return (Row(*row_vals) for row_vals in izip(*self._columns))
 
     ################# Creating new Documents based on this one #################
     def map(self, **names_to_funcs):
@@ -160,10 +759,15 @@ class Document(object):
         """
         def _mapped_col(name, col):
             if name in names_to_funcs:
-                return Column(imap(names_to_funcs[name], col))
+                return self._make_column(imap(names_to_funcs[name], col))
             return col
 
-        return Document((name, _mapped_col(name, col)) for name, col in self)
+        return Document._from_trusted(
+            self._names,
+            tuple(_mapped_col(name, col) for name, col in self),
+            self._Row,
+            self._memory_budget
+        )
 
     def map_all(self, f):
         """Return a new Document that has the same column names as this
@@ -172,7 +776,59 @@ class Document(object):
 
             lower_cased_doc = user_doc.map_all(unicode.lower)
         """
-        return Document((name, Column(imap(f, col))) for name, col in self)
+        return Document._from_trusted(
+            self._names,
+            tuple(self._make_column(imap(f, col)) for col in self._columns),
+            self._Row,
+            self._memory_budget
+        )
+
+    def compress(self, names=None, codec="zlib", block_size=4096):
+        """Return a Document that is the same as this one, except that the
+        Columns named in `names` (a list of names, a single name, or None for
+        all Columns) are stored as :class:`CompressedColumn` objects. Columns that are already
+        compressed are left alone. Example::
+
+            lean_doc = orders_doc.compress(["notes", "shipping_address"])
+        """
+        if names is None:
+            names = self._names
+        elif isinstance(names, basestring):
+            names = [names]
+        names = frozenset(names)
+        unknown_names = names - frozenset(self._names)
+        if unknown_names:
+            raise KeyError("No such columns: %s" % sorted(unknown_names))
+
+        def _compressed_col(name, col):
+            if name in names and not isinstance(col, CompressedColumn):
+                return CompressedColumn(col, codec, block_size)
+            return col
+
+        return Document._from_trusted(
+            self._names,
+            tuple(_compressed_col(name, col) for name, col in self),
+            self._Row,
+            self._memory_budget
+        )
+
+    def with_memory_budget(self, memory_budget):
+        """Return a Document that is the same as this one, except that its
+        Columns are :class:`SpillableColumn` objects tracked by
+        `memory_budget` (a :class:`MemoryBudget`), and so are the Columns of
+        any Documents made from it with map(), select(), etc. Columns that
+        are already compressed or tracked by a budget are left alone."""
+        def _spillable_col(col):
+            if isinstance(col, (CompressedColumn, SpillableColumn)):
+                return col
+            return SpillableColumn(col, memory_budget)
+
+        return Document._from_trusted(
+            self._names,
+            tuple(_spillable_col(col) for col in self._columns),
+            self._Row,
+            memory_budget
+        )
 
     def select(self, *selector_objs):
         """Create a new Document by selecting and optionally transforming
@@ -195,7 +851,17 @@ class Document(object):
         """
         # Make sure they're all Selector objects
         selectors = [Selector.from_unknown(obj) for obj in selector_objs]
-        return Document(s(self) for s in selectors)
+        name_col_pairs = [s(self) for s in selectors]
+
+        # Every Column comes from this Document (transforms preserve length),
+        # so the only thing left to check is that the names are still unique.
+        names = tuple(unicode(name) for name, col in name_col_pairs)
+        columns = tuple(col for name, col in name_col_pairs)
+        if not names:
+            raise TypeError("Document must have at least one Column")
+        self._check_unique_names(names)
+        return Document._from_trusted(names, columns,
+                                      memory_budget=self._memory_budget)
 
     def cols_sorted(self, cmp=None, key=None, reverse=False):
         """Return a Document that is the same as this one, except where the
@@ -203,6 +869,111 @@ class Document(object):
         `sorted` built in, so you can customize how things are compared."""
         return self.select(*sorted(self.names, cmp, key, reverse))
 
+    ################################# Diffing ##################################
+    def diff(self, other, key=None):
+        """Return a :class:`DocumentDiff` describing how to get from this
+        Document to `other`.
+
+        Columns are matched up by name. A column is changed if both Documents
+        have it but its Columns aren't equal.
+
+        Rows are compared using only the columns both Documents have. If `key`
+        is None, rows are matched by their contents, so a row that was edited
+        shows up as one removed row and one added row. If `key` is a column
+        name or a function that takes a Row and returns a hashable value, rows
+        are matched by key, and rows that have the same key but different
+        values show up in `changed_rows`. Keys must be unique in each Document
+        or a :exc:`ValueError` is raised. Example::
+
+            changes = last_night_doc.diff(tonight_doc, key="email")
+            for old_row, new_row in changes.changed_rows:
+                print old_row.email, old_row.last_name, new_row.last_name
+
+        Row values must be hashable.
+        """
+        self_names = frozenset(self._names)
+        other_names = frozenset(other.names)
+        common_names = [name for name in self._names if name in other_names]
+
+        added_cols = tuple(name for name in other.names
+                           if name not in self_names)
+        removed_cols = tuple(name for name in self._names
+                             if name not in other_names)
+        changed_cols = tuple(name for name in common_names
+                             if self[name] != other[name])
+
+        def _rows_with_vals(doc):
+            """(Row, values in the common columns) pairs for `doc`"""
+            common_cols = [doc[name] for name in common_names]
+            if common_cols:
+                return izip(doc.iterrows(), izip(*common_cols))
+            return ((row, ()) for row in doc.iterrows())
+
+        if key is None:
+            added_rows, removed_rows = self._diff_rows_by_value(
+                _rows_with_vals(self), _rows_with_vals(other)
+            )
+            changed_rows = ()
+        else:
+            if isinstance(key, basestring):
+                key_name = key
+                key = lambda row: row[key_name]
+            added_rows, removed_rows, changed_rows = self._diff_rows_by_key(
+                _rows_with_vals(self), _rows_with_vals(other), key
+            )
+
+        return DocumentDiff(added_cols, removed_cols, changed_cols,
+                            added_rows, removed_rows, changed_rows)
+
+    @staticmethod
+    def _diff_rows_by_value(old_rows_with_vals, new_rows_with_vals):
+        old_rows_with_vals = list(old_rows_with_vals)
+        new_rows_with_vals = list(new_rows_with_vals)
+
+        def _unmatched(rows_with_vals, counts):
+            # counts is how many times we've seen each row on the other side
+            unmatched = []
+            for row, vals in rows_with_vals:
+                if counts[vals]:
+                    counts[vals] -= 1
+                else:
+                    unmatched.append(row)
+            return tuple(unmatched)
+
+        old_counts = Counter(vals for row, vals in old_rows_with_vals)
+        new_counts = Counter(vals for row, vals in new_rows_with_vals)
+        return (_unmatched(new_rows_with_vals, old_counts),
+                _unmatched(old_rows_with_vals, new_counts))
+
+    @staticmethod
+    def _diff_rows_by_key(old_rows_with_vals, new_rows_with_vals, key):
+        def _index(rows_with_vals):
+            index = OrderedDict()
+            for row, vals in rows_with_vals:
+                row_key = key(row)
+                if row_key in index:
+                    raise ValueError("Duplicate key in Document diff: %r" %
+                                     (row_key,))
+                index[row_key] = (row, vals)
+            return index
+
+        old_index = _index(old_rows_with_vals)
+        new_index = _index(new_rows_with_vals)
+
+        added_rows = tuple(row for row_key, (row, vals) in new_index.iteritems()
+                           if row_key not in old_index)
+        removed_rows = []
+        changed_rows = []
+        for row_key, (old_row, old_vals) in old_index.iteritems():
+            if row_key not in new_index:
+                removed_rows.append(old_row)
+            else:
+                new_row, new_vals = new_index[row_key]
+                if old_vals != new_vals:
+                    changed_rows.append((old_row, new_row))
+
+        return added_rows, tuple(removed_rows), tuple(changed_rows)
+
 #    def rows_sorted_by(self, *names, cmp=None, key=None, reverse=False):
 #        if not names:
 #            return Document.from_rows(self.names, sorted(self.rows))
@@ -224,29 +995,52 @@ class Document(object):
 
     ################################ Built-ins #################################
     def __add__(self, other):
-        return Document(zip(self.names + other.names,
-                            self.columns + other.columns))
+        names = self._names + other.names
+        columns = self._columns + other.columns
+        self._validate(names, columns)
+        return Document._from_trusted(names, columns,
+                                      memory_budget=self._memory_budget)
 
     def __contains__(self, name_or_col):
-        return (name_or_col in self.names) or (name_or_col in self.columns)
+        if isinstance(name_or_col, basestring):
+            return name_or_col in self._names_to_cols
+        # Only Columns of the right length need their contents compared, and
+        # comparing two Columns checks their cached content hashes first, so
+        # a Column that isn't here is usually rejected without touching data.
+        col = name_or_col
+        if not isinstance(col, (Column, _SequenceColumn)):
+            col = Column(col)
+        num_rows = len(col)
+        return any((doc_col is name_or_col) or
+                   (len(doc_col) == num_rows and doc_col == col)
+                   for doc_col in self._columns)
 
     def __eq__(self, other):
         # Don't compare with self._names_to_cols directly (order matters).
-        return (self.names == other.names) and (self.columns == other.columns)
+        if self is other:
+            return True
+        if (self._names != other.names) or (self.num_rows != other.num_rows):
+            return False
+        return self._columns == other.columns
+
+    def __ne__(self, other):
+        return not self == other
 
     def __iter__(self):
-        return self._names_to_cols.iteritems()
+        return izip(self._names, self._columns)
 
     def __getattr__(self, name):
+        # Go through __dict__ so that we don't recurse forever if we're asked
+        # for an attribute before _init_fields() has run (e.g. while copying).
         try:
-            return self._names_to_cols[name]
+            return self.__dict__['_names_to_cols'][name]
         except KeyError:
             raise AttributeError(name)
 
     def __getitem__(self, index):
         """Get column either by ordered index, or by column name."""
         if isinstance(index, int):
-            return self.columns[index]
+            return self._columns[index]
         elif isinstance(index, basestring):
             return self._names_to_cols[index]
         else:
@@ -254,7 +1048,7 @@ class Document(object):
                             "not %s" % type(index))
 
     def __len__(self):
-        return len(self._names_to_cols)
+        return len(self._names)
 
 
 class Selector(object):
@@ -285,7 +1079,8 @@ class Selector(object):
         pair."""
         name = self._rename if self._rename is not None else self._select
         if self._transform:
-            col = Column(self._transform(x) for x in doc[self._select])
+            col = doc._make_column(self._transform(x)
+                                   for x in doc[self._select])
         else:
             col = doc[self._select]
         return (name, col)
@@ -304,8 +1099,12 @@ class Selector(object):
 # Shorthand for export purposes. I know there's a better way to do this.
 S = Selector
 
+# Number of rows that load() reads and processes at a time.
+LOAD_BATCH_ROWS = 4096
+
 def load(csv_stream, strip_spaces=True, skip_blank_lines=True,
-         encoding="utf-8", delimiter=",", force_unique_col_names=False):
+         encoding="utf-8", delimiter=",", force_unique_col_names=False,
+         compress_cols=None, memory_budget=None):
     """Load CSV from a file or StringIO stream. If `strip_spaces` is True (it is
     by default), we will strip leading and trailing spaces from all entries. If
     skip_blank_lines is True, we ignore all lines for which there is no data in
@@ -314,7 +1113,192 @@ def load(csv_stream, strip_spaces=True, skip_blank_lines=True,
 
     The encoding is utf-8 by default. Another really common encoding for older
     systems is latin-1
+
+    `compress_cols` is an optional list of column names to store as
+    :class:`CompressedColumn` objects (see :meth:`Document.compress`).
+
+    If `memory_budget` (a :class:`MemoryBudget`) is given, the Document's
+    Columns are :class:`SpillableColumn` objects tracked by it (see
+    :meth:`Document.with_memory_budget`). If the data we've loaded so far
+    doesn't fit in the budget, it's spilled to disk as we go.
     """
+    csv_reader, column_headers = _read_header(csv_stream, delimiter,
+                                              force_unique_col_names)
+    num_cols = len(column_headers)
+    compress_cols = frozenset(compress_cols or ())
+    unknown_compress_cols = compress_cols - frozenset(column_headers)
+    if unknown_compress_cols:
+        raise KeyError("No such columns: %s" % sorted(unknown_compress_cols))
+
+    # Make a list to gather entries for each column in the data file. Columns
+    # we're compressing are compressed as we go instead.
+    raw_text_cols = [list() for i in range(num_cols)]
+    compressed_cols = dict((i, CompressedColumn._builder())
+                           for i, name in enumerate(column_headers)
+                           if name in compress_cols)
+
+    # If we have a memory budget, keep track of roughly how much memory the
+    # lists are taking up, and append them to spill files when they don't
+    # fit. Compressed columns are already being kept small, so we leave them.
+    spill_files = [None] * num_cols
+    spill_col_indexes = [i for i, name in enumerate(column_headers)
+                         if name not in compress_cols]
+    est_bytes = [0] * num_cols
+    unspilled_bytes = 0
+    num_rows = 0
+
+    try:
+        for rows in _iter_row_batches(csv_reader, strip_spaces,
+                                      skip_blank_lines):
+            num_rows += len(rows)
+            batch_cols = _rows_to_cols(rows, num_cols, strip_spaces, encoding)
+            for i, cells in enumerate(batch_cols):
+                if i in compressed_cols:
+                    compressed_cols[i]._extend(cells)
+                else:
+                    raw_text_cols[i].extend(cells)
+
+            if memory_budget is not None:
+                for i in spill_col_indexes:
+                    batch_bytes = _estimate_bytes(batch_cols[i])
+                    est_bytes[i] += batch_bytes
+                    unspilled_bytes += batch_bytes
+                memory_budget.enforce(extra_bytes=unspilled_bytes)
+                if memory_budget.resident_bytes + unspilled_bytes > \
+                   memory_budget.max_bytes:
+                    for i in spill_col_indexes:
+                        if spill_files[i] is None:
+                            spill_files[i] = _SpillFile(memory_budget.spill_dir)
+                        spill_files[i].write(raw_text_cols[i])
+                        raw_text_cols[i] = []
+                    unspilled_bytes = 0
+
+        # Now take the raw data and put it into our Columns. We let go of each
+        # list as we go, so we're never holding two copies of every column at
+        # once.
+        cols = []
+        for i, name in enumerate(column_headers):
+            raw_col, raw_text_cols[i] = raw_text_cols[i], None
+            if i in compressed_cols:
+                compressed_cols[i]._finish()
+                cols.append(compressed_cols[i])
+            elif memory_budget is None:
+                cols.append(Column(raw_col))
+            elif spill_files[i] is not None:
+                spill_files[i].write(raw_col)
+                spill_files[i].close()
+                cols.append(SpillableColumn._from_spill_file(
+                    spill_files[i], num_rows, est_bytes[i], memory_budget
+                ))
+                # The SpillableColumn cleans it up from here on.
+                spill_files[i] = None
+            else:
+                cols.append(SpillableColumn(raw_col, memory_budget))
+    except:
+        # Nothing owns the spill files we've made so far, so nobody else is
+        # going to delete them.
+        for spill_file in spill_files:
+            if spill_file is not None:
+                spill_file.remove()
+        raise
+
+    names = tuple(unicode(name) for name in column_headers)
+    cols = tuple(cols)
+    Document._validate(names, cols)
+    return Document._from_trusted(names, cols, memory_budget=memory_budget)
+
+def sample(csv_stream, n, method="head", seed=None, strip_spaces=True,
+           skip_blank_lines=True, encoding="utf-8", delimiter=",",
+           force_unique_col_names=False):
+    """Load a Document with (at most) `n` rows from a CSV file or StringIO
+    stream, for previews and quick profiling of big files. The other
+    arguments work the same way they do in :func:`load`.
+
+    If `method` is "head" (the default), we take the first `n` rows and stop
+    reading. If `method` is "reservoir", we read through the whole stream once
+    and take a uniform random sample of `n` rows, keeping them in the order
+    they appear in the file. Only the sampled rows are ever decoded, and we
+    never hold more than `n` rows (plus a batch being read) in memory. `seed`
+    is passed to :class:`random.Random` so that samples can be repeated::
+
+        preview_doc = csvcols.sample(open("orders.csv"), 1000,
+                                     method="reservoir", seed=42)
+    """
+    if method not in ("head", "reservoir"):
+        raise ValueError("sample() method must be 'head' or 'reservoir', " \
+                         "not %r" % (method,))
+
+    csv_reader, column_headers = _read_header(csv_stream, delimiter,
+                                              force_unique_col_names)
+    num_cols = len(column_headers)
+    if n <= 0:
+        rows = []
+    elif method == "head":
+        rows = []
+        batch_rows = min(n, LOAD_BATCH_ROWS)
+        for batch in _iter_row_batches(csv_reader, strip_spaces,
+                                       skip_blank_lines, batch_rows):
+            rows.extend(batch[:n - len(rows)])
+            if len(rows) == n:
+                break
+    else:
+        rows = _reservoir_sample(
+            _iter_row_batches(csv_reader, strip_spaces, skip_blank_lines),
+            n, random.Random(seed)
+        )
+
+    cols = [Column(cells) for cells
+            in _rows_to_cols(rows, num_cols, strip_spaces, encoding)]
+    return Document(zip(column_headers, cols))
+
+# The largest float less than 1.0
+_MAX_WEIGHT = 1.0 - 2.0 ** -53
+
+def _reservoir_sample(row_batches, n, rng):
+    """Return a uniform sample of `n` rows (in their original order) from an
+    iterator of row batches. This is Li's "Algorithm L", which works out how
+    many rows to skip before the next replacement instead of rolling the dice
+    for every row."""
+    def _random():
+        # In (0, 1), since we take logs of it.
+        value = rng.random()
+        while value == 0.0:
+            value = rng.random()
+        return value
+
+    def _next_weight(weight):
+        # For big samples this can round to 1.0, which would leave nothing to
+        # take the log of in _skip(), so keep it just under.
+        return min(weight * math.exp(math.log(_random()) / n), _MAX_WEIGHT)
+
+    def _skip():
+        return int(math.floor(math.log(_random()) / math.log1p(-weight)))
+
+    reservoir = []  # (row number, row) pairs
+    weight = None
+    next_row_num = None
+    start_row_num = 0
+    for rows in row_batches:
+        end_row_num = start_row_num + len(rows)
+        if len(reservoir) < n:
+            reservoir.extend(izip(count(start_row_num),
+                                  rows[:n - len(reservoir)]))
+            if len(reservoir) == n:
+                weight = _next_weight(1.0)
+                next_row_num = n + _skip()
+        while (next_row_num is not None) and (next_row_num < end_row_num):
+            reservoir[rng.randrange(n)] = \
+                (next_row_num, rows[next_row_num - start_row_num])
+            weight = _next_weight(weight)
+            next_row_num += _skip() + 1
+        start_row_num = end_row_num
+
+    reservoir.sort(key=itemgetter(0))
+    return [row for row_num, row in reservoir]
+
+def _read_header(csv_stream, delimiter, force_unique_col_names):
+    """Return a csv reader for `csv_stream` and the list of column names from
+    its first line."""
     def _force_unique(col_headers):
         seen_names = set()
         unique_col_headers = list()
@@ -325,41 +1309,66 @@ def load(csv_stream, strip_spaces=True, skip_blank_lines=True,
             unique_col_headers.append(col_name)
         return unique_col_headers
 
-    def _pad_row(row):
-        if len(row) < num_cols:
-            for i in range(num_cols - len(row)):
-                row.append('')
-        return row
-
-    def _process_row(row):
-        if strip_spaces:
-            return _pad_row([value.strip() for value in row])
-        else:
-            return _pad_row(row)
-
     csv_reader = csv.reader(csv_stream, delimiter=delimiter)
 
     column_headers = [header.strip() for header in csv_reader.next()]
     if force_unique_col_names:
         column_headers = _force_unique(column_headers)
-    num_cols = len(column_headers)
+    return csv_reader, column_headers
 
-    # Make a list to gather entries for each column in the data file...
-    raw_text_cols = [list() for i in range(num_cols)]
-    for row in csv_reader:
-        processed_row = _process_row(row)
-        # Add this new row if we either allow blank lines or if any field
-        # in the line is not blank. We do this to the processed row,
-        # because spaces may or may not be significant, depending on
-        # whether strip_spaces is True.
-        if (not skip_blank_lines) or any(processed_row):
-            for i in range(num_cols):
-                raw_text_cols[i].append(processed_row[i].decode(encoding))
-
-    # Now take the raw data and put it into our Column...
-    cols = [Column(raw_col) for raw_col in raw_text_cols]
+def _iter_row_batches(csv_reader, strip_spaces, skip_blank_lines,
+                      batch_rows=None):
+    """Read rows from `csv_reader` in batches (lists of up to `batch_rows`
+    rows, LOAD_BATCH_ROWS by default), leaving out blank rows if
+    `skip_blank_lines` is True. Rows are left as the csv module gives them to
+    us (undecoded, unstripped, unpadded)."""
+    if batch_rows is None:
+        batch_rows = LOAD_BATCH_ROWS
+    while True:
+        rows = list(islice(csv_reader, batch_rows))
+        if not rows:
+            break
 
-    return Document(zip(column_headers, cols))
+        # Add rows if we either allow blank lines or if any field in the line
+        # is not blank. We do this to the whole row (including any extra fields
+        # past the last column), after stripping if strip_spaces is True,
+        # because spaces may or may not be significant. A row is blank after
+        # stripping exactly when all its fields joined together are blank.
+        if skip_blank_lines:
+            joined_rows = imap(''.join, rows)
+            if strip_spaces:
+                joined_rows = imap(str.strip, joined_rows)
+            rows = list(compress(rows, joined_rows))
+            if not rows:
+                continue
+
+        yield rows
+
+def _rows_to_cols(rows, num_cols, strip_spaces, encoding):
+    """Turn a list of rows from the csv module into `num_cols` lists of decoded
+    (and optionally stripped) cells. We do the per-cell work a column at a time
+    with builtins, so that we're not running Python code for every cell."""
+    def _decode_cells(cells):
+        # The csv module won't parse NUL bytes, so we can use them to glue a
+        # whole batch of cells together and decode it in one go. If the codec
+        # does something odd with them, fall back to decoding cell by cell.
+        decoded = '\x00'.join(cells).decode(encoding).split(u'\x00')
+        if len(decoded) != len(cells):
+            decoded = [cell.decode(encoding) for cell in cells]
+        return decoded
+
+    if not rows:
+        return [[] for i in range(num_cols)]
+
+    # Transpose to columns, padding short rows with blanks and dropping any
+    # extra fields in long ones.
+    cols = list(islice(izip_longest(*rows, fillvalue=''), num_cols))
+    for i in range(len(cols), num_cols):
+        cols.append(('',) * len(rows))
+
+    if strip_spaces:
+        cols = [map(str.strip, cells) for cells in cols]
+    return [_decode_cells(cells) for cells in cols]
 
 def loads(csv_str, *args, **kwargs):
     """Like :func:`load`, but takes a String object instead of a stream."""
@@ -371,3 +1380,203 @@ def dump(doc, stream):
 def dumps(doc):
     pass
 
+
+class Pipeline(object):
+    """A Pipeline checkpoints the output of each stage of your work to a local
+    cache directory, so that when you rerun it (say, after fixing a bug in a
+    late stage), stages whose inputs haven't changed are loaded from disk
+    instead of being recomputed.
+
+    A stage is a function that takes one or more Documents as positional
+    arguments and returns a Document. Declare stages with the :meth:`stage`
+    decorator::
+
+        pipeline = csvcols.Pipeline("/tmp/shipping_cache",
+                                    max_cache_bytes=2 * 1024 ** 3)
+
+        @pipeline.stage(version=2)
+        def users(raw_shipping_doc):
+            return raw_shipping_doc.select(...)
+
+        @pipeline.stage()
+        def merged_users(users_doc):
+            return users_doc.merge_rows_on(...)
+
+        raw_shipping_doc = csvcols.load(open("shipping_orders.csv"))
+        final_doc = merged_users(users(raw_shipping_doc))
+
+    A stage's checkpoint is keyed by the stage's name, its `version`, and the
+    :attr:`Document.fingerprint` of each of its inputs. Documents returned by
+    a stage are fingerprinted by that key, so chained stages never have to
+    hash their inputs' contents. Bump `version` whenever you change what a
+    stage does, or you'll keep getting the old results.
+
+    Checkpoints are written and read a Column at a time. CompressedColumns
+    come back compressed, and if any of a stage's inputs are under a
+    :class:`MemoryBudget`, the other Columns come back as spilled
+    SpillableColumns under that budget.
+
+    If `max_cache_bytes` is set, the least recently used checkpoints are
+    deleted whenever the cache grows past it (the newest checkpoint is always
+    kept).
+    """
+    CHECKPOINT_EXT = ".ckpt"
+
+    # Bump this when the checkpoint file format changes, so that old
+    # checkpoints are ignored rather than misread.
+    CHECKPOINT_FORMAT = 2
+    HEADER_LENGTH = struct.Struct("<Q")
+
+    def __init__(self, cache_dir, max_cache_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def stage(self, version=0, name=None):
+        """Decorator that turns a function into a checkpointed stage. `name`
+        defaults to the function's module and name, and should be set if you
+        have two stages that would otherwise have the same name."""
+        def _decorator(func):
+            stage_name = name
+            if stage_name is None:
+                stage_name = "%s.%s" % (func.__module__, func.__name__)
+
+            @functools.wraps(func)
+            def _run_stage(*docs):
+                return self._run(func, stage_name, version, docs)
+            return _run_stage
+
+        return _decorator
+
+    def _run(self, func, stage_name, version, docs):
+        for doc in docs:
+            if not isinstance(doc, Document):
+                raise TypeError("Pipeline stage %s must be called with " \
+                                "Documents, not %s" % (stage_name, type(doc)))
+
+        key = self._checkpoint_key(stage_name, version, docs)
+        path = os.path.join(self.cache_dir, key + self.CHECKPOINT_EXT)
+        if os.path.exists(path):
+            # Mark it as recently used, for eviction purposes.
+            os.utime(path, None)
+            memory_budget = next((doc._memory_budget for doc in docs
+                                  if doc._memory_budget is not None), None)
+            return self._read_checkpoint(path, key, memory_budget)
+
+        doc = func(*docs)
+        if not isinstance(doc, Document):
+            raise TypeError("Pipeline stage %s must return a Document, not " \
+                            "%s" % (stage_name, type(doc)))
+        self._write_checkpoint(path, doc)
+        if self.max_cache_bytes is not None:
+            self._evict(keep=path)
+
+        # Fingerprint the output by the key that produced it. The stage might
+        # have handed back one of its inputs (or some other Document that's
+        # used elsewhere), so we do this on a new Document sharing its Columns
+        # rather than overwriting the fingerprint of the one we were given.
+        doc = Document._from_trusted(doc.names, doc.columns, doc._Row,
+                                     doc._memory_budget)
+        doc._fingerprint = key
+        return doc
+
+    @classmethod
+    def _checkpoint_key(cls, stage_name, version, docs):
+        sha = hashlib.sha1()
+        sha.update(cPickle.dumps((cls.CHECKPOINT_FORMAT, stage_name, version),
+                                 cPickle.HIGHEST_PROTOCOL))
+        for doc in docs:
+            sha.update(doc.fingerprint)
+        return sha.hexdigest()
+
+    def _read_checkpoint(self, path, key, memory_budget):
+        """Read a checkpoint back in a Column at a time (see the class
+        docstring for what kinds of Columns we make)."""
+        with open(path, "rb") as checkpoint_file:
+            header_length, = self.HEADER_LENGTH.unpack(
+                checkpoint_file.read(self.HEADER_LENGTH.size))
+            names, num_rows, col_infos = cPickle.loads(
+                checkpoint_file.read(header_length))
+
+            cols = []
+            for kind, info in col_infos:
+                if kind == "compressed":
+                    codec, block_size = info
+                    cols.append(CompressedColumn(
+                        _SpillFile.iter_block_values(checkpoint_file),
+                        codec, block_size
+                    ))
+                elif memory_budget is None:
+                    cols.append(
+                        Column(_SpillFile.iter_block_values(checkpoint_file)))
+                else:
+                    # Copy the blocks straight into a spill file, without
+                    # ever decompressing them.
+                    spill_file = _SpillFile(memory_budget.spill_dir)
+                    try:
+                        for raw_block in \
+                                _SpillFile.iter_raw_blocks(checkpoint_file):
+                            spill_file.write_raw_block(raw_block)
+                        spill_file.close()
+                    except:
+                        spill_file.remove()
+                        raise
+                    cols.append(SpillableColumn._from_spill_file(
+                        spill_file, num_rows, info, memory_budget
+                    ))
+
+        doc = Document._from_trusted(names, tuple(cols),
+                                     memory_budget=memory_budget)
+        doc._fingerprint = key
+        return doc
+
+    def _write_checkpoint(self, path, doc):
+        """Write `doc` out a Column at a time, so that spilled Columns never
+        have to be read back into memory. The file starts with a pickled
+        header of (names, num_rows, [(kind, info) for each Column]), where
+        kind is "compressed" (info is its codec and block size) or "column"
+        (info is its estimated size in memory). After that come each
+        Column's blocks in the _SpillFile format."""
+        def _col_info(col):
+            if isinstance(col, CompressedColumn):
+                return ("compressed", (col._codec, col._block_size))
+            if isinstance(col, SpillableColumn):
+                return ("column", col._est_bytes)
+            return ("column", _estimate_bytes(col))
+
+        header = cPickle.dumps(
+            (doc.names, doc.num_rows, [_col_info(col) for col in doc.columns]),
+            cPickle.HIGHEST_PROTOCOL
+        )
+
+        # Write to a temp file and rename it into place, so that a crash in the
+        # middle of writing doesn't leave a truncated checkpoint behind.
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(self.HEADER_LENGTH.pack(len(header)))
+                temp_file.write(header)
+                for col in doc.columns:
+                    _SpillFile.write_blocks(temp_file, col)
+                    temp_file.write(_SpillFile.END_OF_BLOCKS)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _evict(self, keep):
+        checkpoints = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(self.CHECKPOINT_EXT):
+                path = os.path.join(self.cache_dir, file_name)
+                stat = os.stat(path)
+                checkpoints.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for mtime, size, path in checkpoints)
+        for mtime, size, path in sorted(checkpoints):
+            if total_bytes <= self.max_cache_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total_bytes -= size
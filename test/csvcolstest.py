@@ -1,9 +1,16 @@
+import cPickle
+import datetime
+import os
+import shutil
 import string
+import tempfile
 from unittest import TestCase
 
 from nose.tools import *
 
-from csvcols import Column, Document, S, loads, dumps
+import csvcols
+from csvcols import Column, CompressedColumn, Document, MemoryBudget, \
+                    Pipeline, S, SpillableColumn, loads, dumps, sample
 
 
 class TestDocument(TestCase):
@@ -21,9 +28,9 @@ class TestDocument(TestCase):
         """Test basic ordered access to names and columns."""
         doc = self.users_doc
 
-        assert_equal(doc.names, ["first_name", "last_name", "gender"])
+        assert_equal(doc.names, ("first_name", "last_name", "gender"))
         assert_equal(doc.columns,
-                     [self.first_name, self.last_name, self.gender])
+                     (self.first_name, self.last_name, self.gender))
 
         assert_equal(doc.first_name, doc[0])
         assert_equal(doc.first_name, doc["first_name"])
@@ -34,6 +41,10 @@ class TestDocument(TestCase):
 
         assert_equal(len(doc.last_name), 4)
 
+        # Columns are shared, not copied
+        assert_true(doc[1] is self.last_name)
+        assert_true(doc["gender"] is self.gender)
+
     
     def test_row_accessors(self):
         names_doc = Document([("First Name", self.first_name),
@@ -65,7 +76,176 @@ class TestDocument(TestCase):
         # Even if it's not the exact same object, if the Columns are equal, 
         # this should return True
         assert_true(Column(["David", "Brian", "Sonya", "Alexis"]) in doc)
+        assert_true(["David", "Brian", "Sonya", "Alexis"] in doc)
+        assert_false(Column(["David", "Brian", "Sonya", "Alexi"]) in doc)
+
+    def test_derived_documents(self):
+        """Documents derived from this one share its Columns (and its Row class
+        when the names don't change)."""
+        doc = self.users_doc
+        Row = doc.Row
+        mapped_doc = doc.map(gender=unicode.upper)
+        assert_true(mapped_doc.Row is Row)
+        assert_true(mapped_doc.first_name is doc.first_name)
+        assert_equal(mapped_doc.names, doc.names)
+        assert_equal(mapped_doc.rows[2].gender, "FEMALE")
+
+        selected_doc = doc.select(("last_name", "surname"), "gender")
+        assert_equal(selected_doc.names, ("surname", "gender"))
+        assert_true(selected_doc.surname is doc.last_name)
+        assert_true(self.gender in selected_doc)
+        assert_false(self.first_name in selected_doc)
+        assert_equal(selected_doc.rows[1].surname, "Lee")
+
+    @raises(TypeError)
+    def test_select_nothing(self):
+        self.users_doc.select()
+
+    @raises(TypeError)
+    def test_select_duplicate_names(self):
+        self.users_doc.select("first_name", ("last_name", "first_name"))
     
+    def test_equality(self):
+        doc = self.users_doc
+        assert_equal(doc, doc)
+        assert_equal(doc, doc.select("first_name", "last_name", "gender"))
+        assert_not_equal(doc, doc.map(gender=unicode.upper))
+        assert_not_equal(doc, doc.select("first_name", "gender", "last_name"))
+
+        # Equal contents, different objects
+        assert_equal(self.first_name,
+                     Column([u"David", u"Brian", u"Sonya", u"Alexis"]))
+        assert_equal(hash(self.first_name),
+                     hash(Column([u"David", u"Brian", u"Sonya", u"Alexis"])))
+        assert_not_equal(self.first_name, self.last_name)
+        assert_not_equal(self.first_name, self.first_name[:2])
+        assert_not_equal(self.first_name, ["David", "Brian", "Sonya"])
+
+        # Columns with unhashable contents still compare
+        dict_col = Column([{"a": 1}, {"b": 2}])
+        assert_equal(dict_col, Column([{"a": 1}, {"b": 2}]))
+        assert_not_equal(dict_col, Column([{"a": 1}, {"b": 3}]))
+
+    def test_pickling_leaves_out_cached_hash(self):
+        hash(self.first_name)
+        col = cPickle.loads(cPickle.dumps(self.first_name, 2))
+        assert_true(type(col) is Column)
+        assert_false(hasattr(col, "_cached_hash"))
+        assert_equal(col, self.first_name)
+
+        compressed_col = CompressedColumn(self.first_name)
+        hash(compressed_col)
+        compressed_col = cPickle.loads(cPickle.dumps(compressed_col, 2))
+        assert_false(hasattr(compressed_col, "_cached_hash"))
+        assert_equal(compressed_col, self.first_name)
+
+    def test_diff(self):
+        old_doc = self.users_doc
+        new_doc = Document([
+            ("first_name", Column([u"David", u"Sonya", u"Alexis", u"Jo"])),
+            ("last_name", Column([u"Smith", u"Kim", u"Dough", u"Park"])),
+            ("email", Column([u"d@example.com", u"s@example.com",
+                              u"a@example.com", u"j@example.com"])),
+        ])
+        assert_false(old_doc.diff(old_doc))
+
+        by_value = old_doc.diff(new_doc)
+        assert_true(by_value)
+        assert_equal(by_value.added_cols, ("email",))
+        assert_equal(by_value.removed_cols, ("gender",))
+        assert_equal(by_value.changed_cols, ("first_name", "last_name"))
+        assert_equal([(r.first_name, r.last_name) for r in by_value.added_rows],
+                     [("Alexis", "Dough"), ("Jo", "Park")])
+        assert_equal([(r.first_name, r.last_name)
+                      for r in by_value.removed_rows],
+                     [("Brian", "Lee"), ("Alexis", "Doe")])
+        assert_equal(by_value.changed_rows, ())
+
+        by_key = old_doc.diff(new_doc, key="first_name")
+        assert_equal([r.first_name for r in by_key.added_rows], ["Jo"])
+        assert_equal([r.first_name for r in by_key.removed_rows], ["Brian"])
+        assert_equal([(old.last_name, new.last_name)
+                      for old, new in by_key.changed_rows],
+                     [("Doe", "Dough")])
+        # Rows keep all the columns from their own Document
+        assert_equal(by_key.changed_rows[0][0].gender, "Female")
+        assert_equal(by_key.changed_rows[0][1].email, "a@example.com")
+
+        by_func = old_doc.diff(new_doc, key=lambda row: row.first_name[0])
+        assert_equal(by_func.changed_rows, by_key.changed_rows)
+
+    @raises(ValueError)
+    def test_diff_duplicate_keys(self):
+        self.users_doc.diff(self.users_doc, key="gender")
+
+    def test_compress(self):
+        doc = self.users_doc
+        compressed_doc = doc.compress(["last_name", "gender"])
+        assert_true(compressed_doc.first_name is doc.first_name)
+        assert_true(isinstance(compressed_doc.last_name, CompressedColumn))
+        assert_equal(compressed_doc, doc)
+        assert_equal(compressed_doc.rows, doc.rows)
+        assert_equal(compressed_doc.gender[-1], "Female")
+        assert_equal(compressed_doc.gender[1:3], ("Male", "Female"))
+        assert_equal(compressed_doc.gender.unique, frozenset(["Male", "Female"]))
+        assert_true(self.gender in compressed_doc)
+        assert_equal(compressed_doc.compress().gender, self.gender)
+
+        single_doc = doc.compress("gender")
+        assert_true(isinstance(single_doc.gender, CompressedColumn))
+        assert_true(single_doc.last_name is doc.last_name)
+
+    def test_compressed_column(self):
+        values = [u"note %d" % (i % 7) for i in range(1000)]
+        for codec in ["zlib", "bz2"]:
+            col = CompressedColumn(values, codec=codec, block_size=64)
+            assert_equal(len(col), 1000)
+            assert_equal(list(col), values)
+            assert_equal(col[999], values[999])
+            assert_equal(col[-64], values[-64])
+            assert_equal(col, Column(values))
+            assert_equal(Column(values), col)
+            assert_equal(hash(col), hash(Column(values)))
+            assert_not_equal(col, CompressedColumn(values[1:] + [u"x"]))
+            assert_true(col.compressed_size < len(u"".join(values)))
+
+        # Non-builtin types still work
+        dates = [datetime.date(2012, 7, day) for day in range(1, 31)]
+        assert_equal(list(CompressedColumn(dates, block_size=8)), dates)
+
+    def test_compressed_column_comparison(self):
+        values = [u"note %d" % i for i in range(1000)]
+        col = CompressedColumn(values, block_size=64)
+        other_col = CompressedColumn(values, block_size=100)
+        assert_equal(col, other_col)
+        assert_equal(Column(values), col)
+        assert_not_equal(col, CompressedColumn(values[:-1] + [u"x"]))
+        assert_not_equal(Column(values[:-1] + [u"x"]), col)
+        # Comparing doesn't make us work out (and cache) content hashes
+        assert_false(hasattr(col, "_cached_hash"))
+        assert_false(hasattr(other_col, "_cached_hash"))
+
+    def test_compressed_column_cache_sizes(self):
+        values = range(100)
+        for cached_blocks in [0, 1, 3]:
+            col = CompressedColumn(values, block_size=8,
+                                   cached_blocks=cached_blocks)
+            assert_equal([col[i] for i in [0, 50, 9, 99, 1, 50]],
+                         [0, 50, 9, 99, 1, 50])
+            assert_true(len(col._block_cache) <= cached_blocks)
+
+    @raises(ValueError)
+    def test_compressed_column_block_size(self):
+        CompressedColumn(range(10), block_size=0)
+
+    @raises(ValueError)
+    def test_compress_block_size(self):
+        self.users_doc.compress(block_size=0)
+
+    @raises(IndexError)
+    def test_compressed_column_index_error(self):
+        CompressedColumn([u"a", u"b"])[2]
+
     def test_add_documents(self):
         doc1 = self.users_doc
         doc2 = Document([("last2", self.last_name),
@@ -133,7 +313,7 @@ class TestDocument(TestCase):
     def test_sorted_cols(self):
         sorted_cols_doc = self.users_doc.cols_sorted()
         assert_equals(sorted_cols_doc.names, 
-                      ["first_name", "gender", "last_name"])
+                      ("first_name", "gender", "last_name"))
 
     # def test_sorted_rows(self):
     #     sorted_rows = self.users_doc.rows_sorted()
@@ -147,7 +327,7 @@ class TestDocument(TestCase):
             S("last_name", transform=unicode.lower),
         )
         assert_equal(modified_users_doc.names,
-                     ["gender", "LAST NAME", "1st Name", "last_name"])
+                     ("gender", "LAST NAME", "1st Name", "last_name"))
         assert_equal(modified_users_doc["LAST NAME"], 
                      ["SMITH", "LEE", "KIM", "DOE"])
         assert_equal(modified_users_doc["1st Name"], self.users_doc.first_name)
@@ -184,19 +364,346 @@ class TestLoading(TestCase):
         assert_equal(not_stripped.BILLING_FIRST,
                      ["  Dave", "Rusty", "Jack", " clyde "])
 
+    def test_encoding_and_ragged_rows(self):
+        text = u"name,city\n Zo\xeb ,M\xfcnchen\n\t,  \n,,x\nAl\n".encode(
+                   "latin-1")
+        doc = loads(text, encoding="latin-1")
+        assert_equal(doc.name, [u"Zo\xeb", u"", u"Al"])
+        assert_equal(doc.city, [u"M\xfcnchen", u"", u""])
+
+        doc = loads(text.decode("latin-1").encode("utf-8"), strip_spaces=False,
+                    skip_blank_lines=False)
+        assert_equal(doc.name, [u" Zo\xeb ", u"\t", u"", u"Al"])
+        assert_equal(doc.city, [u"M\xfcnchen", u"  ", u"", u""])
+
+    def test_batches(self):
+        """Loading in small batches gives the same result."""
+        expected = [loads(INVOICE_CSV_TEXT, skip_blank_lines=skip)
+                    for skip in [True, False]]
+        batch_rows = csvcols.LOAD_BATCH_ROWS
+        try:
+            for num_rows in range(1, 8):
+                csvcols.LOAD_BATCH_ROWS = num_rows
+                assert_equal([loads(INVOICE_CSV_TEXT, skip_blank_lines=skip)
+                              for skip in [True, False]],
+                             expected)
+        finally:
+            csvcols.LOAD_BATCH_ROWS = batch_rows
+
+    def test_compress_cols(self):
+        doc = loads(INVOICE_CSV_TEXT, compress_cols=["email"])
+        assert_true(isinstance(doc.email, CompressedColumn))
+        assert_false(isinstance(doc.BILLING_FIRST, CompressedColumn))
+        assert_equal(doc, loads(INVOICE_CSV_TEXT))
+
+        # Columns are compressed a batch at a time as we load
+        lines = ["id,notes"] + ["%d,note %d" % (i, i) for i in range(100)]
+        text = "\n".join(lines)
+        batch_rows = csvcols.LOAD_BATCH_ROWS
+        csvcols.LOAD_BATCH_ROWS = 7
+        try:
+            doc = loads(text, compress_cols=["notes"])
+        finally:
+            csvcols.LOAD_BATCH_ROWS = batch_rows
+        assert_equal(doc, loads(text))
+        assert_equal(doc.notes[99], "note 99")
+
+    def test_compressed_column_builder(self):
+        col = CompressedColumn._builder(block_size=8)
+        for start in range(0, 100, 7):
+            col._extend(range(start, min(start + 7, 100)))
+        col._finish()
+        assert_equal(len(col), 100)
+        assert_equal(list(col), range(100))
+        assert_equal(col[57], 57)
+        assert_equal(col, CompressedColumn(range(100), block_size=8))
+
+
+class TestSampling(TestCase):
 
+    def setUp(self):
+        self.lines_read = 0
+
+    def _lines(self, num_rows):
+        """CSV lines with a header and `num_rows` numbered rows, with a blank
+        line after every row. Keeps track of how many lines were read."""
+        lines = ["num, name"]
+        for i in range(num_rows):
+            lines.extend([" %d ,name_%d" % (i, i), ",  "])
+        for line in lines:
+            self.lines_read += 1
+            yield line + "\n"
+
+    def test_head(self):
+        doc = sample(self._lines(10000), 3)
+        assert_equal(doc.names, ("num", "name"))
+        assert_equal(doc.num, ["0", "1", "2"])
+        assert_equal(doc.name, ["name_0", "name_1", "name_2"])
+        # We stopped reading early
+        assert_true(self.lines_read < 100)
+
+        doc = sample(self._lines(10), 3, strip_spaces=False,
+                     skip_blank_lines=False)
+        assert_equal(doc.num, [" 0 ", "", " 1 "])
+
+        assert_equal(sample(self._lines(2), 10).num, ["0", "1"])
+        assert_equal(sample(self._lines(2), 0).num_rows, 0)
+
+    def test_reservoir(self):
+        doc = sample(self._lines(1000), 10, method="reservoir", seed=1)
+        assert_equal(doc.num_rows, 10)
+        assert_equal(self.lines_read, 2001)
+        nums = [int(num) for num in doc.num]
+        assert_equal(nums, sorted(nums))
+        assert_equal(len(set(nums)), 10)
+        assert_equal(doc.name, ["name_%d" % num for num in nums])
+
+        # Seeds make samples repeatable
+        assert_equal(sample(self._lines(1000), 10, "reservoir", seed=1), doc)
+
+        # Asking for more than there is gives you everything
+        assert_equal(sample(self._lines(5), 10, "reservoir").num,
+                     ["0", "1", "2", "3", "4"])
+
+    def test_reservoir_is_uniform(self):
+        # Small batches, so that we cross batch boundaries while sampling
+        batch_rows = csvcols.LOAD_BATCH_ROWS
+        csvcols.LOAD_BATCH_ROWS = 3
+        try:
+            counts = [0] * 20
+            for seed in range(500):
+                doc = sample(self._lines(20), 5, "reservoir", seed=seed)
+                for num in doc.num:
+                    counts[int(num)] += 1
+        finally:
+            csvcols.LOAD_BATCH_ROWS = batch_rows
+        # Each row should be picked about 500 * 5 / 20 = 125 times
+        assert_true(min(counts) > 80, counts)
+        assert_true(max(counts) < 170, counts)
+
+    def test_reservoir_weight_near_one(self):
+        """With big samples, Algorithm L's weight can round to 1.0."""
+        class AlmostOneRandom(object):
+            def random(self):
+                return 1.0 - 2.0 ** -53
+            def randrange(self, n):
+                return 0
+
+        batches = [[[str(i)] for i in range(start, start + 5)]
+                   for start in range(0, 20, 5)]
+        rows = csvcols._reservoir_sample(iter(batches), 2, AlmostOneRandom())
+        assert_equal(len(rows), 2)
+
+    @raises(ValueError)
+    def test_bad_method(self):
+        sample(self._lines(5), 2, method="tail")
+
+
+class TestMemoryBudget(TestCase):
 
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        lines = ["id,name,notes"]
+        lines.extend("%d,name_%d,some notes about %d" % (i, i, i)
+                     for i in range(5000))
+        self.csv_text = "\n".join(lines)
+        self.doc = loads(self.csv_text)
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def _spill_files(self):
+        return os.listdir(self.spill_dir)
+
+    def test_load(self):
+        # Enough for any one Column, but not for all of them
+        col_bytes = [csvcols._estimate_bytes(col) for col in self.doc.columns]
+        budget = MemoryBudget(max(col_bytes) * 1.5, self.spill_dir)
+        doc = loads(self.csv_text, memory_budget=budget)
+        assert_true(all(isinstance(col, SpillableColumn) for col in doc.columns))
+        assert_true(any(col.spilled for col in doc.columns))
+        assert_true(budget.resident_bytes <= budget.max_bytes)
+        assert_true(self._spill_files())
+
+        # Streaming doesn't read anything back in
+        spilled = tuple(col for col in doc.columns if col.spilled)
+        assert_equal(list(doc.iterrows()), list(self.doc.iterrows()))
+        assert_true(all(col.spilled for col in spilled))
+        assert_equal(doc, self.doc)
+
+        # Random access does
+        assert_equal(doc.notes[4999], "some notes about 4999")
+        assert_false(doc.notes.spilled)
+        assert_true(budget.resident_bytes <= budget.max_bytes)
+
+        del doc, spilled
+        assert_equal(self._spill_files(), [])
+        assert_equal(budget.resident_bytes, 0)
+
+    def test_failed_load_cleans_up(self):
+        bad_text = self.csv_text + "\n5000,\xff,bad encoding"
+        budget = MemoryBudget(1, self.spill_dir)
+        assert_raises(UnicodeDecodeError, loads, bad_text,
+                      memory_budget=budget)
+        assert_equal(self._spill_files(), [])
+
+    def test_default_spill_dir_is_removed(self):
+        budget = MemoryBudget(1)
+        doc = loads(self.csv_text, memory_budget=budget)
+        spill_dir = budget.spill_dir
+        assert_true(os.listdir(spill_dir))
+        del doc, budget
+        assert_false(os.path.exists(spill_dir))
+
+    def test_iterate_temporary_document(self):
+        budget = MemoryBudget(1, self.spill_dir)
+        rows = [tuple(row) for row
+                in loads(self.csv_text, memory_budget=budget).iterrows()]
+        assert_equal(rows, [tuple(row) for row in self.doc.iterrows()])
+
+        doc = loads(self.csv_text, memory_budget=budget)
+        assert_true(doc.name.spilled)
+        name_iter = iter(doc.name)
+        del doc
+        assert_equal(list(name_iter), list(self.doc.name))
+        assert_equal(self._spill_files(), [])
+
+    def test_lru(self):
+        # Not quite enough for all three Columns
+        col_bytes = [csvcols._estimate_bytes(col) for col in self.doc.columns]
+        budget = MemoryBudget(sum(col_bytes) - 1, self.spill_dir)
+        doc = self.doc.with_memory_budget(budget)
+        assert_equal([col.spilled for col in doc.columns], [True, False, False])
+
+        doc.id[0]
+        assert_equal([col.spilled for col in doc.columns], [False, True, False])
+        doc.notes[0]
+        doc.id[0]
+        assert_equal([col.spilled for col in doc.columns], [False, True, False])
+
+    def test_transforms_are_tracked(self):
+        budget = MemoryBudget(1, self.spill_dir)
+        doc = self.doc.with_memory_budget(budget)
+        derived_docs = [doc.map(name=unicode.upper),
+                        doc.map_all(unicode.upper),
+                        doc.select(S("name", transform=unicode.upper), "id"),
+                        doc.select(("name", "name2")) + doc]
+        for derived_doc in derived_docs:
+            for col in derived_doc.columns:
+                assert_true(isinstance(col, SpillableColumn))
+        assert_equal(derived_docs[1], self.doc.map_all(unicode.upper))
+        assert_equal(derived_docs[2].name[1], "NAME_1")
+
+        # Only the Column being used is ever kept in memory
+        assert_true(sum(not col.spilled for derived_doc in derived_docs
+                        for col in derived_doc.columns) <= 1)
+
+
+class TestPipeline(TestCase):
 
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.doc = loads(INVOICE_CSV_TEXT)
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _checkpoints(self):
+        return [f for f in os.listdir(self.cache_dir)
+                if f.endswith(Pipeline.CHECKPOINT_EXT)]
+
+    def _make_stages(self, pipeline, version=0):
+        @pipeline.stage(version=version)
+        def names(doc):
+            self.calls.append("names")
+            return doc.select(("BILLING_FIRST", "first"),
+                              ("BILLING_LAST", "last"))
+
+        @pipeline.stage()
+        def upper(doc):
+            self.calls.append("upper")
+            return doc.map_all(unicode.upper)
+
+        return names, upper
+
+    def test_checkpoints_are_reused(self):
+        names, upper = self._make_stages(Pipeline(self.cache_dir))
+        first_run = upper(names(self.doc))
+        assert_equal(self.calls, ["names", "upper"])
+        assert_equal(first_run.first, ["DAVE", "RUSTY", "JACK", "CLYDE"])
+        assert_equal(len(self._checkpoints()), 2)
+
+        # A new Pipeline over the same directory, as if we'd restarted.
+        names, upper = self._make_stages(Pipeline(self.cache_dir))
+        second_run = upper(names(loads(INVOICE_CSV_TEXT)))
+        assert_equal(self.calls, ["names", "upper"])
+        assert_equal(second_run, first_run)
+        assert_equal(second_run.fingerprint, first_run.fingerprint)
+
+    def test_changes_invalidate_checkpoints(self):
+        names, upper = self._make_stages(Pipeline(self.cache_dir))
+        upper(names(self.doc))
+
+        # Bumping a version reruns that stage, and everything downstream
+        names, upper = self._make_stages(Pipeline(self.cache_dir), version=1)
+        upper(names(self.doc))
+        assert_equal(self.calls, ["names", "upper", "names", "upper"])
+
+        # So does changing the input
+        upper(names(self.doc.map(email=unicode.upper)))
+        assert_equal(self.calls, ["names", "upper", "names", "upper",
+                                  "names", "upper"])
+
+    def test_eviction(self):
+        pipeline = Pipeline(self.cache_dir, max_cache_bytes=1)
+        names, upper = self._make_stages(pipeline)
+        names_doc = names(self.doc)
+        upper(names_doc)
+        assert_equal(len(self._checkpoints()), 1)
+
+        # Only the last stage's output survived
+        upper(names_doc)
+        assert_equal(self.calls, ["names", "upper"])
+        names(self.doc)
+        assert_equal(self.calls, ["names", "upper", "names"])
+
+    def test_checkpoints_keep_compression(self):
+        pipeline = Pipeline(self.cache_dir)
+        stage = pipeline.stage()(lambda doc: doc.compress("email"))
+        first_run = stage(self.doc)
+        second_run = stage(self.doc)
+        assert_equal(second_run, first_run)
+        assert_is_instance(second_run.email, CompressedColumn)
+        assert_not_is_instance(second_run.BILLING_FIRST, CompressedColumn)
+
+    def test_checkpoints_read_back_under_budget(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            budget = MemoryBudget(1, spill_dir=spill_dir)
+            doc = self.doc.with_memory_budget(budget)
+            names, upper = self._make_stages(Pipeline(self.cache_dir))
+            first_run = names(doc)
+            second_run = names(doc)
+            assert_equal(self.calls, ["names"])
+            assert_equal(second_run, first_run)
+            for col in second_run.columns:
+                assert_is_instance(col, SpillableColumn)
+                assert_true(col.spilled)
+            assert_equal(list(second_run.first),
+                         ["Dave", "Rusty", "Jack", "clyde"])
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_stage_returning_input(self):
+        pipeline = Pipeline(self.cache_dir)
+        fingerprint = self.doc.fingerprint
+        output = pipeline.stage()(lambda doc: doc)(self.doc)
+        assert_equal(self.doc.fingerprint, fingerprint)
+        assert_not_equal(output.fingerprint, fingerprint)
+        assert_equal(output, self.doc)
 
-
-
-
-
-
-
-
-
-
-
-
-
+    @raises(TypeError)
+    def test_stage_must_return_document(self):
+        pipeline = Pipeline(self.cache_dir)
+        pipeline.stage()(lambda doc: doc.names)(self.doc)